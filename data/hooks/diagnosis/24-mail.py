@@ -2,8 +2,9 @@
 
 import os
 import dns.resolver
-import re
+import socket
 
+from multiprocessing.pool import ThreadPool
 from subprocess import CalledProcessError
 
 from moulinette.utils.process import check_output
@@ -15,6 +16,41 @@ from yunohost.settings import settings_get
 from yunohost.utils.network import dig
 
 DEFAULT_DNS_BLACKLIST = "/usr/share/yunohost/other/dnsbl_list.yml"
+POSTFIX_SPOOL = "/var/spool/postfix"
+POSTFIX_QUEUES = ["maildrop", "incoming", "active", "deferred", "hold"]
+
+# Shared DNS cache, so that answers are reused (within their TTL) across
+# diagnosis runs happening in the same process (e.g. yunohost-api)
+DNS_CACHE = dns.resolver.LRUCache(max_size=10000)
+
+# Parsed DNS blacklists list, indexed by the file's (mtime, size)
+_dns_blacklists = {}
+
+
+def _get_item_type(item):
+    """
+    Tell if an item to check against DNSBL is an 'ipv4', 'ipv6' or 'domain'
+    """
+
+    for family, item_type in ((socket.AF_INET, 'ipv4'), (socket.AF_INET6, 'ipv6')):
+        try:
+            socket.inet_pton(family, item)
+        except (socket.error, ValueError):
+            continue
+        return item_type
+
+    return 'domain'
+
+
+def _get_dns_blacklists():
+
+    st = os.stat(DEFAULT_DNS_BLACKLIST)
+    cache_key = (st.st_mtime, st.st_size)
+    if cache_key not in _dns_blacklists:
+        _dns_blacklists.clear()
+        _dns_blacklists[cache_key] = read_yaml(DEFAULT_DNS_BLACKLIST)
+
+    return _dns_blacklists[cache_key]
 
 
 class MailDiagnoser(Diagnoser):
@@ -22,6 +58,12 @@ class MailDiagnoser(Diagnoser):
     id_ = os.path.splitext(os.path.basename(__file__))[0].split("-")[1]
     cache_duration = 600
     dependencies = ["ip"]
+    checks = ["check_outgoing_port_25", "check_ehlo", "check_fcrdns",
+              "check_blacklist", "check_queue"]
+    # Checks only doing DNS queries, which can be ran in the background while
+    # the other ones are running. The other checks can't run concurrently
+    # because remote_diagnosis() monkey patches socket.getaddrinfo
+    background_checks = ["check_fcrdns", "check_blacklist"]
 
     def run(self):
 
@@ -34,18 +76,29 @@ class MailDiagnoser(Diagnoser):
         # TODO Validate DKIM and dmarc ?
         # TODO check that the recent mail logs are not filled with thousand of email sending (unusual number of mail sent)
         # TODO check for unusual failed sending attempt being refused in the logs ?
-        checks = ["check_outgoing_port_25", "check_ehlo", "check_fcrdns",
-                  "check_blacklist", "check_queue"]
-        for check in checks:
-            self.logger_debug("Running " + check)
-            reports = list(getattr(self, check)())
-            for report in reports:
-                yield report
-            if not reports:
-                name = check[6:]
-                yield dict(meta={"test": "mail_" + name},
-                        status="SUCCESS",
-                        summary="diagnosis_mail_" + name + "_ok")
+        pool = ThreadPool(len(self.background_checks))
+        try:
+            pending = {check: pool.apply_async(self._run_check, (check,))
+                       for check in self.background_checks}
+            for check in self.checks:
+                if check in pending:
+                    reports = pending[check].get()
+                else:
+                    reports = self._run_check(check)
+                for report in reports:
+                    yield report
+                if not reports:
+                    name = check[len("check_"):]
+                    yield dict(meta={"test": "mail_" + name},
+                               status="SUCCESS",
+                               summary="diagnosis_mail_" + name + "_ok")
+        finally:
+            pool.close()
+            pool.join()
+
+    def _run_check(self, check):
+        self.logger_debug("Running " + check)
+        return list(getattr(self, check)())
 
     def check_outgoing_port_25(self):
         """
@@ -53,9 +106,19 @@ class MailDiagnoser(Diagnoser):
         This check is ran on IPs we could used to send mail.
         """
 
-        for ipversion in self.ipversions:
-            cmd = '/bin/nc -{ipversion} -z -w2 yunohost.org 25'.format(ipversion=ipversion)
-            if os.system(cmd) != 0:
+        if not self.ipversions:
+            return
+
+        # Probe each ip version concurrently, to not wait twice on a timeout
+        pool = ThreadPool(len(self.ipversions))
+        try:
+            reachable = pool.map(self._can_connect_to_port_25, self.ipversions)
+        finally:
+            pool.close()
+            pool.join()
+
+        for ipversion, ok in zip(self.ipversions, reachable):
+            if not ok:
                 yield dict(meta={"test": "outgoing_port_25", "ipversion": ipversion},
                            data={},
                            status="ERROR",
@@ -63,6 +126,34 @@ class MailDiagnoser(Diagnoser):
                            details=["diagnosis_mail_outgoing_port_25_blocked_details",
                                     "diagnosis_mail_outgoing_port_25_blocked_relay_vpn"])
 
+    @staticmethod
+    def _can_connect_to_port_25(ipversion):
+        """
+        Try to open a TCP connection to yunohost.org:25 using the given
+        ip version (equivalent of `nc -z -w2`, without forking)
+        """
+
+        family = socket.AF_INET if ipversion == 4 else socket.AF_INET6
+        try:
+            addrinfos = socket.getaddrinfo("yunohost.org", 25, family, socket.SOCK_STREAM)
+        except socket.error:
+            return False
+
+        for af, socktype, proto, _, address in addrinfos:
+            s = None
+            try:
+                s = socket.socket(af, socktype, proto)
+                s.settimeout(2)
+                s.connect(address)
+                return True
+            except socket.error:
+                continue
+            finally:
+                if s is not None:
+                    s.close()
+
+        return False
+
     def check_ehlo(self):
         """
         Check the server is reachable from outside and it's the good one
@@ -123,7 +214,7 @@ class MailDiagnoser(Diagnoser):
                 query += '.ip6.arpa'
 
             # Do the DNS Query
-            status, value = dig(query, 'PTR', resolvers="force_external")
+            status, value = dig(query, 'PTR', timeout=3, lifetime=3, resolvers="force_external", cache=DNS_CACHE)
             if status == "nok":
                 yield dict(meta={"test": "mail_fcrdns", "ipversion": ipversion},
                            data={"ip": ip, "ehlo_domain": self.ehlo_domain},
@@ -151,59 +242,85 @@ class MailDiagnoser(Diagnoser):
         This check is ran on IPs and domains we could used to send mail.
         """
 
-        dns_blacklists = read_yaml(DEFAULT_DNS_BLACKLIST)
+        dns_blacklists = _get_dns_blacklists()
+
+        # Classify each item once, and build the query prefix for DNSBL
+        items = []
         for item in self.ips + self.mail_domains:
-            for blacklist in dns_blacklists:
-                item_type = "domain"
-                if ":" in item:
-                    item_type = 'ipv6'
-                elif re.match(r'^\d+\.\d+\.\d+\.\d+$', item):
-                    item_type = 'ipv4'
-
-                if not blacklist[item_type]:
-                    continue
-
-                # Build the query for DNSBL
-                subdomain = item
-                if item_type != "domain":
-                    rev = dns.reversename.from_address(item)
-                    subdomain = str(rev.split(3)[0])
-                query = subdomain + '.' + blacklist['dns_server']
-
-                # Do the DNS Query
-                status, _ = dig(query, 'A')
-                if status != 'ok':
-                    continue
-
-                # Try to get the reason
-                details = []
-                status, answers = dig(query, 'TXT')
-                reason = "-"
-                if status == 'ok':
-                    reason = ', '.join(answers)
-                    details.append("diagnosis_mail_blacklist_reason")
-
-                details.append("diagnosis_mail_blacklist_website")
-
-                yield dict(meta={"test": "mail_blacklist", "item": item,
-                                 "blacklist": blacklist["dns_server"]},
-                           data={'blacklist_name': blacklist['name'],
-                                 'blacklist_website': blacklist['website'],
-                                 'reason': reason},
-                           status="ERROR",
-                           summary='diagnosis_mail_blacklist_listed_by',
-                           details=details)
+            item_type = _get_item_type(item)
+            subdomain = item
+            if item_type != "domain":
+                rev = dns.reversename.from_address(item)
+                subdomain = str(rev.split(3)[0])
+            items.append((item, item_type, subdomain))
+
+        # Build the list of DNSBL queries to run
+        queries = [(item, blacklist, subdomain + '.' + blacklist['dns_server'])
+                   for item, item_type, subdomain in items
+                   for blacklist in dns_blacklists
+                   if blacklist[item_type]]
+
+        if not queries:
+            return
+
+        # The queries are network-bound, so run them concurrently instead of
+        # waiting on each remote DNSBL server one after the other
+        pool = ThreadPool(min(len(queries), 32))
+        try:
+            results = pool.map(self._query_blacklist, queries)
+        finally:
+            pool.close()
+            pool.join()
+
+        for item, blacklist, listed, reason in results:
+            if not listed:
+                continue
+
+            details = []
+            if reason:
+                details.append("diagnosis_mail_blacklist_reason")
+
+            details.append("diagnosis_mail_blacklist_website")
+
+            yield dict(meta={"test": "mail_blacklist", "item": item,
+                             "blacklist": blacklist["dns_server"]},
+                       data={'blacklist_name': blacklist['name'],
+                             'blacklist_website': blacklist['website'],
+                             'reason': reason or "-"},
+                       status="ERROR",
+                       summary='diagnosis_mail_blacklist_listed_by',
+                       details=details)
+
+    @staticmethod
+    def _query_blacklist(args):
+        """
+        Query a DNSBL for an item
+        Returns whether the item is listed and, if available, the reason why
+        """
+
+        item, blacklist, query = args
+
+        # Do the DNS Query
+        status, _ = dig(query, 'A', lifetime=5, cache=DNS_CACHE)
+        if status != 'ok':
+            return (item, blacklist, False, None)
+
+        # Try to get the reason
+        status, answers = dig(query, 'TXT', lifetime=5, cache=DNS_CACHE)
+        reason = None
+        if status == 'ok':
+            reason = ', '.join(answers)
+
+        return (item, blacklist, True, reason)
 
     def check_queue(self):
         """
         Check mail queue is not filled with hundreds of email pending
         """
 
-        command = 'postqueue -p | grep -v "Mail queue is empty" | grep -c "^[A-Z0-9]" || true'
         try:
-            output = check_output(command)
-            pending_emails = int(output)
-        except (ValueError, CalledProcessError) as e:
+            pending_emails = self._count_pending_emails()
+        except (ValueError, OSError, CalledProcessError) as e:
             yield dict(meta={"test": "mail_queue"},
                        data={"error": str(e)},
                        status="ERROR",
@@ -221,6 +338,32 @@ class MailDiagnoser(Diagnoser):
                            status="SUCCESS",
                            summary="diagnosis_mail_queue_ok")
 
+    @staticmethod
+    def _count_pending_emails():
+        """
+        Count the emails in postfix queues, by directly counting the files in
+        the spool (which is what postqueue reads), or by parsing postqueue's
+        output if the spool can't be read
+        """
+
+        def raise_error(e):
+            raise e
+
+        try:
+            return sum(len(files)
+                       for queue in POSTFIX_QUEUES
+                       for _, _, files in os.walk(os.path.join(POSTFIX_SPOOL, queue),
+                                                  onerror=raise_error))
+        except OSError:
+            pass
+
+        # Each queued email starts with its queue ID (e.g. "8A2E5C0512*")
+        output = check_output(["postqueue", "-p"], shell=False)
+        if "Mail queue is empty" in output:
+            return 0
+        return sum(1 for line in output.split("\n")
+                   if line[:1].isalnum() and not line[:1].islower())
+
     def get_ips_checked(self):
         outgoing_ipversions = []
         outgoing_ips = []
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+import os
+import imp
+import pytest
+
+mail_hook = imp.load_source("mail_hook", os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                      "../../../data/hooks/diagnosis/24-mail.py"))
+
+
+@pytest.mark.parametrize("item,expected", [
+    ("1.2.3.4", "ipv4"),
+    ("203.0.113.42", "ipv4"),
+    ("1.2.3.4.5", "domain"),
+    ("1.2.3", "domain"),
+    ("256.1.1.1", "domain"),
+    ("::1", "ipv6"),
+    ("2001:db8::1", "ipv6"),
+    ("2001:0db8:0000:0000:0000:ff00:0042:8329", "ipv6"),
+    ("example.com", "domain"),
+    (u"example.com", "domain"),
+    (u"éxample.fr", "domain"),
+])
+def test_get_item_type(item, expected):
+    assert mail_hook._get_item_type(item) == expected
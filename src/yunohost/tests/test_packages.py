@@ -0,0 +1,72 @@
+import pytest
+
+from mock import patch
+from packaging import version
+
+from yunohost.utils.packages import _parse_version_specifier, _list_upgradable_apt_packages
+
+
+@pytest.mark.parametrize("specifier,expected", [
+    (">> 1.2.3", (">>", "1.2.3")),
+    (">=3.8", (">=", "3.8")),
+    ("  <= 4.0.1  ", ("<=", "4.0.1")),
+    ("<<4", ("<<", "4")),
+    ("= 3.7.1", ("=", "3.7.1")),
+    (">= 3.8.1~ynh1", (">=", "3.8.1")),
+    ("<< 4.0+201910", ("<<", "4.0")),
+    ("= 3.7.1-2", ("=", "3.7.1")),
+])
+def test_parse_version_specifier(specifier, expected):
+    op, req_version = _parse_version_specifier(specifier)
+    assert (op, req_version) == (expected[0], version.parse(expected[1]))
+    assert isinstance(req_version, version.Version)
+
+
+@pytest.mark.parametrize("specifier", [
+    "",
+    "3.8",
+    ">=",
+    "=>3.5",
+    "> 3.5",
+    "< 3.5",
+    "== 3.5",
+    ">= foo",
+    ">= ~ynh1",
+])
+def test_parse_version_specifier_invalid(specifier):
+    with pytest.raises(ValueError):
+        _parse_version_specifier(specifier)
+
+
+APT_LIST_OUTPUT = """
+WARNING: apt does not have a stable CLI interface. Use with caution in scripts.
+
+Listing...
+yunohost/stable 3.5.0.2+201903211853 all [upgradable from: 3.4.2.4+201903080053]
+libc6/stable 2.28-10+deb10u1 amd64 [upgradable from: 2.28-10]
+php7.3-fpm/stable,stable 7.3.19-1~deb10u1 amd64 [upgradable from: 7.3.14-1~deb10u1]
+foo/stable 1.2.3 all
+"""
+
+
+def test_list_upgradable_apt_packages():
+    with patch("yunohost.utils.packages.check_output", return_value=APT_LIST_OUTPUT):
+        upgradables = list(_list_upgradable_apt_packages())
+
+    assert upgradables == [
+        {"name": "yunohost",
+         "new_version": "3.5.0.2+201903211853",
+         "current_version": "3.4.2.4+201903080053"},
+        {"name": "libc6",
+         "new_version": "2.28-10+deb10u1",
+         "current_version": "2.28-10"},
+        {"name": "php7.3-fpm",
+         "new_version": "7.3.19-1~deb10u1",
+         "current_version": "7.3.14-1~deb10u1"},
+    ]
+
+
+def test_list_upgradable_apt_packages_nothing_to_upgrade():
+    output = "WARNING: apt does not have a stable CLI interface. Use with caution in scripts.\n\nListing..."
+    with patch("yunohost.utils.packages.check_output", return_value=output):
+        assert list(_list_upgradable_apt_packages()) == []
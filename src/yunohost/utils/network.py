@@ -127,9 +127,15 @@ def external_resolvers():
     return external_resolvers_
 
 
-def dig(qname, rdtype="A", timeout=5, resolvers="local", edns_size=1500, full_answers=False):
+def dig(qname, rdtype="A", timeout=5, resolvers="local", edns_size=1500, full_answers=False, cache=None, lifetime=None):
     """
     Do a quick DNS request and avoid the "search" trap inside /etc/resolv.conf
+
+    A dns.resolver.Cache (or LRUCache) instance may be provided as `cache` to
+    reuse answers (within their TTL) across calls
+
+    `timeout` applies to each attempt, while `lifetime` (if provided) bounds
+    the total time spent on the query, retries included
     """
 
     # It's very important to do the request with a qname ended by .
@@ -149,6 +155,10 @@ def dig(qname, rdtype="A", timeout=5, resolvers="local", edns_size=1500, full_an
     resolver.use_edns(0, 0, edns_size)
     resolver.nameservers = resolvers
     resolver.timeout = timeout
+    if cache is not None:
+        resolver.cache = cache
+    if lifetime is not None:
+        resolver.lifetime = lifetime
     try:
         answers = resolver.query(qname, rdtype)
     except (dns.resolver.NXDOMAIN,
@@ -20,6 +20,9 @@
 """
 import re
 import os
+import gzip
+import errno
+import fcntl
 import logging
 
 from moulinette.utils.process import check_output
@@ -28,6 +31,30 @@ from packaging import version
 logger = logging.getLogger('yunohost.utils.packages')
 
 YUNOHOST_PACKAGES = ['yunohost', 'yunohost-admin', 'moulinette', 'ssowat']
+DPKG_UPDATE_REGEX = re.compile(r'^[0-9]+$')
+VERSION_REGEX = re.compile(r'^[0-9]+(\.[0-9]+)*$')
+APT_UPGRADABLE_REGEX = re.compile(r'^(?P<name>[^/\s]+)/\S+\s+(?P<new_version>\S+)\s+\S+\s+'
+                                  r'\[upgradable from:\s+(?P<current_version>[^\]\s]+)\]\s*$')
+
+# cmp is a python builtin that returns (-1, 0, 1) depending on comparison
+DEB_OPERATORS = {
+    "<<": lambda v1, v2: cmp(v1, v2) in [-1],
+    "<=": lambda v1, v2: cmp(v1, v2) in [-1, 0],
+    "=": lambda v1, v2: cmp(v1, v2) in [0],
+    ">=": lambda v1, v2: cmp(v1, v2) in [0, 1],
+    ">>": lambda v1, v2: cmp(v1, v2) in [1]
+}
+
+# Versions read from the packages changelogs, as (mtime, size, version)
+# indexed by changelog path, so that a package upgrade invalidates the entry
+_package_versions = {}
+
+# Parsed (and trimmed) installed versions, indexed by the raw version string
+_installed_versions = {}
+
+# Parsed version specifiers, to avoid re-parsing the same strings when
+# checking e.g. the requirements of several apps
+_version_specifiers = {}
 
 
 def get_ynh_package_version(package):
@@ -40,13 +67,22 @@ def get_ynh_package_version(package):
     # may handle changelog differently !
 
     changelog = "/usr/share/doc/%s/changelog.gz" % package
-    cmd = "gzip -cd %s 2>/dev/null | head -n1" % changelog
     if not os.path.exists(changelog):
         return {"version": "?", "repo": "?"}
-    out = check_output(cmd).split()
-    # Output looks like : "yunohost (1.2.3) testing; urgency=medium"
-    return {"version": out[1].strip("()"),
-            "repo": out[2].strip(";")}
+
+    # The changelog only changes when the package is upgraded, so we can
+    # reuse the previous result as long as the file is the same
+    st = os.stat(changelog)
+    cached = _package_versions.get(changelog)
+    if cached is None or cached[:2] != (st.st_mtime, st.st_size):
+        with gzip.open(changelog) as f:
+            out = f.readline().split()
+        # Output looks like : "yunohost (1.2.3) testing; urgency=medium"
+        cached = (st.st_mtime, st.st_size, {"version": out[1].strip("()"),
+                                             "repo": out[2].strip(";")})
+        _package_versions[changelog] = cached
+
+    return dict(cached[2])
 
 
 def meets_version_specifier(pkg_name, specifier):
@@ -63,23 +99,32 @@ def meets_version_specifier(pkg_name, specifier):
     # context
     assert pkg_name in YUNOHOST_PACKAGES
     pkg_version = get_ynh_package_version(pkg_name)["version"]
-    pkg_version = re.split(r'\~|\+|\-', pkg_version)[0]
-    pkg_version = version.parse(pkg_version)
+    if pkg_version not in _installed_versions:
+        _installed_versions[pkg_version] = version.parse(re.split(r'\~|\+|\-', pkg_version)[0])
+    pkg_version = _installed_versions[pkg_version]
 
     # Extract operator and version specifier
-    op, req_version = re.search(r'(<<|<=|=|>=|>>) *([\d\.]+)', specifier).groups()
-    req_version = version.parse(req_version)
+    op, req_version = _parse_version_specifier(specifier)
 
-    # cmp is a python builtin that returns (-1, 0, 1) depending on comparison
-    deb_operators = {
-        "<<": lambda v1, v2: cmp(v1, v2) in [-1],
-        "<=": lambda v1, v2: cmp(v1, v2) in [-1, 0],
-        "=": lambda v1, v2: cmp(v1, v2) in [0],
-        ">=": lambda v1, v2: cmp(v1, v2) in [0, 1],
-        ">>": lambda v1, v2: cmp(v1, v2) in [1]
-    }
+    return DEB_OPERATORS[op](pkg_version, req_version)
 
-    return deb_operators[op](pkg_version, req_version)
+
+def _parse_version_specifier(specifier):
+    """
+    Split a specifier like ">> 1.2.3" into its operator and parsed version
+    """
+
+    if specifier not in _version_specifiers:
+        # Operators are either "=" or two chars long, so just look them up
+        spec = specifier.strip()
+        op = spec[:2] if spec[:2] in DEB_OPERATORS else spec[:1]
+        # Trim any ~foobar, like for the installed version
+        req_version = re.split(r'\~|\+|\-', spec[len(op):].strip())[0]
+        if op not in DEB_OPERATORS or not VERSION_REGEX.match(req_version):
+            raise ValueError("Invalid version specifier: %s" % specifier)
+        _version_specifiers[specifier] = (op, version.parse(req_version))
+
+    return _version_specifiers[specifier]
 
 
 def ynh_packages_version(*args, **kwargs):
@@ -102,39 +147,64 @@ def dpkg_is_broken():
     # ref: https://sources.debian.org/src/apt/1.4.9/apt-pkg/deb/debsystem.cc/#L141-L174
     if not os.path.isdir("/var/lib/dpkg/updates/"):
         return False
-    return any(re.match("^[0-9]+$", f)
+    return any(DPKG_UPDATE_REGEX.match(f)
                for f in os.listdir("/var/lib/dpkg/updates/"))
 
 
 def dpkg_lock_available():
-    return os.system("lsof /var/lib/dpkg/lock >/dev/null") != 0
+
+    # dpkg (and apt) take a fcntl() record lock on this file, so check if we
+    # could take that lock ourselves (and release it right away)
+    try:
+        fd = os.open("/var/lib/dpkg/lock", os.O_RDWR)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return True
+        raise
+
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            return False
+        raise
+    else:
+        fcntl.lockf(fd, fcntl.LOCK_UN)
+        return True
+    finally:
+        os.close(fd)
 
 
 def _list_upgradable_apt_packages():
 
     # List upgradable packages
     # LC_ALL=C is here to make sure the results are in english
-    upgradable_raw = check_output("LC_ALL=C apt list --upgradable")
+    upgradable_raw = check_output(["apt", "list", "--upgradable"], shell=False,
+                                  env=dict(os.environ, LC_ALL="C"))
 
     # Dirty parsing of the output
-    upgradable_raw = [l.strip() for l in upgradable_raw.split("\n") if l.strip()]
-    for line in upgradable_raw:
+    for line in upgradable_raw.split("\n"):
+
+        # Package lines always contain a "/" (between name and suite), which
+        # quickly discards empty lines and most of the noise
+        if "/" not in line:
+            continue
 
         # Remove stupid warning and verbose messages >.>
-        if "apt does not have a stable CLI interface" in line or "Listing..." in line:
+        if "apt does not have a stable CLI interface" in line or line.startswith(("Listing", "WARNING")):
             continue
 
         # line should look like :
         # yunohost/stable 3.5.0.2+201903211853 all [upgradable from: 3.4.2.4+201903080053]
-        line = line.split()
-        if len(line) != 6:
-            logger.warning("Failed to parse this line : %s" % ' '.join(line))
+        m = APT_UPGRADABLE_REGEX.match(line)
+        if not m:
+            logger.warning("Failed to parse this line : %s" % line.strip())
             continue
 
         yield {
-            "name": line[0].split("/")[0],
-            "new_version": line[1],
-            "current_version": line[5].strip("]"),
+            "name": m.group("name"),
+            "new_version": m.group("new_version"),
+            "current_version": m.group("current_version"),
         }
 
 
@@ -144,8 +214,9 @@ def _dump_sources_list():
 
     filenames = glob("/etc/apt/sources.list") + glob("/etc/apt/sources.list.d/*")
     for filename in filenames:
+        prefix = filename[len("/etc/apt/"):] + ":"
         with open(filename, "r") as f:
-            for line in f.readlines():
+            for line in f:
                 if line.startswith("#") or not line.strip():
                     continue
-                yield filename.replace("/etc/apt/", "") + ":" + line.strip()
+                yield prefix + line.strip()